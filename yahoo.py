@@ -11,30 +11,69 @@
 # NOTE some of the auth and token urls in yahoo tutorials seem wrong or out of
 # date. This last oauth2 guide from yahoo has the correct newest urls
 
-import argparse
+import concurrent.futures
+import getpass
 import json
+import logging
 import os
+import sqlite3
 import sys
+import tempfile
+import threading
 import time
-import warnings
 
-import requests_oauthlib
+try:
+  from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+  # same contract as orjson: compact serialization to bytes, parsing from bytes or str
+  def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+  _json_loads = json.loads
 
+# fdatasync is linux-only; fsync is the portable equivalent
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+logger = logging.getLogger(__name__)
+# only this module's tracing; requests_oauthlib logs tokens and client secrets at DEBUG
+if os.environ.get('YAHOO_DEBUG', '').lower() not in ('', '0', 'false', 'no'):
+  logger.setLevel(logging.DEBUG)
 
 _OAUTH_GET_TOKEN_URL = 'https://api.login.yahoo.com/oauth2/get_token'
 _OAUTH_REFRESH_TOKEN_URL = 'https://api.login.yahoo.com/oauth2/get_token'
 _OAUTH_REQUEST_AUTH_URL = 'https://api.login.yahoo.com/oauth2/request_auth'
-_TMP_DIR = '/tmp/'
+# resolved once at import. XDG_RUNTIME_DIR is a per-user tmpfs on linux; gettempdir covers everything else
+_TOKEN_DIR = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+# where tokens lived before XDG_RUNTIME_DIR was used. Still checked on load, since cron/CI runs usually lack
+# XDG_RUNTIME_DIR and a logout clears it
+_LEGACY_TOKEN_DIR = tempfile.gettempdir()
+# token path -> (st_mtime_ns, token), so several YahooOAuth instances in one process parse the file once
+_TOKEN_CACHE = {}
+# seconds a cached GET is served without revalidation, by first matching url path substring. Anything else
+# (rosters, matchups, standings) is revalidated with a conditional GET on every call
+_RESPONSE_TTLS = (
+    ('/settings', 7 * 24 * 3600),
+    ('/draftresults', 7 * 24 * 3600),
+    ('/scoreboard', 3600),
+)
+_DEFAULT_RESPONSE_TTL = 0
+# retry policy for transient api errors, shared by the requests adapter and the HTTP/2 client. Once retries run out
+# both return the last response rather than raising
+_RETRY_TOTAL = 3
+_RETRY_BACKOFF_FACTOR = 0.3
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
 # _LEAGUE_KEYS = {'2023': 423, '2022': 414, '2021': 406, '2020': 399}
 
 
 def make_parser():
+  import argparse  # pylint: disable=import-outside-toplevel
   parser = argparse.ArgumentParser()
   parser.add_argument('--league_id', type=str)
   parser.add_argument('--client_id', type=str)
   parser.add_argument('--client_secret', type=str)
-  parser.add_argument('--redirect_uri', type=str, default='oob')
+  parser.add_argument('--redirect_uri', type=str, help="defaults to 'oob' if YAHOO_REDIRECT_URI is also unset")
   parser.add_argument('--force_refresh_token', action='store_true')
+  parser.add_argument('--http2', action='store_true', help='send requests over HTTP/2 (requires httpx[http2])')
   return parser
 
 
@@ -43,36 +82,175 @@ def main(argv=None):
     argv = sys.argv[1:]
   parser = make_parser()
   args = parser.parse_args(argv)
+  logging.basicConfig(level=logging.INFO)
   creds = obtain_credentials(args)
-  x = YahooOAuth(creds['client_id'], creds['client_secret'], args.league_id,
-                 force_refresh_token=args.force_refresh_token)
-  x.test_auth()
+  oauth = YahooOAuth(creds['client_id'], creds['client_secret'], args.league_id, redirect_uri=creds['redirect_uri'],
+                     force_refresh_token=args.force_refresh_token, http2=args.http2)
+  oauth.close()
 
 
 class YahooOAuth:
-  def __init__(self, client_id, client_secret, league_id, redirect_uri=None, force_refresh_token=False):
+  def __init__(self, client_id, client_secret, league_id, redirect_uri=None, force_refresh_token=False,
+               http2=False, cache_responses=True):
     self.client_id = client_id
     self.client_secret = client_secret
     self.league_id = league_id
-    self.league_url = f'https://fantasysports.yahooapis.com/fantasy/v2/league/nfl.l.{self.league_id}'
+    self.league_url = sys.intern(f'https://fantasysports.yahooapis.com/fantasy/v2/league/nfl.l.{self.league_id}')
     if redirect_uri is None:
       redirect_uri = 'oob'
     self.redirect_uri = redirect_uri
     self.token = None
     self.client = None
-    if force_refresh_token:
-      self.update_client(expires_at=-10)
+    # seconds before expires_at at which update_client treats the token as stale
+    self._skew = 60
+    # remaining token lifetime as of the last update_token_expiration
+    self._seconds_remaining = None
+    # serializes refreshes and token writes across get_many worker threads. Reentrant since refresh_token
+    # calls token_updater
+    self._refresh_lock = threading.RLock()
+    self._token_path = get_token_filepath(client_id)
+    # the http stack is imported here rather than at module level so --help and credential prompts don't pay for it
+    from requests.adapters import HTTPAdapter  # pylint: disable=import-outside-toplevel
+    from urllib3.util.retry import Retry  # pylint: disable=import-outside-toplevel
+    # one adapter (and so one urllib3 connection pool) shared by the auth-code session and the long-lived
+    # client session, so keep-alive connections to yahoo are reused
+    self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                max_retries=Retry(total=_RETRY_TOTAL, backoff_factor=_RETRY_BACKOFF_FACTOR,
+                                                  status_forcelist=_RETRY_STATUSES, raise_on_status=False))
+    # optional HTTP/2 client for api GETs, multiplexing concurrent requests over one connection. The OAuth2Session
+    # still owns the token and does the refreshing
+    self._http2 = None
+    if http2:
+      import httpx  # pylint: disable=import-outside-toplevel
+      # match the requests path: no timeout, and redirects followed
+      self._http2 = httpx.Client(http2=True, timeout=None, follow_redirects=True)
+    self.response_cache = None
+    if cache_responses:
+      cache_path = get_response_cache_filepath(client_id)
+      try:
+        self.response_cache = ResponseCache(cache_path)
+      except OSError as e:
+        logger.warning(f'not caching responses, {cache_path} is unusable: {e}')
+    self._bootstrap(force_refresh_token)
+    self.test_auth()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+    """Release the http sessions and the response cache connection"""
+    if self._http2 is not None:
+      self._http2.close()
+    if self.client is not None:
+      self.client.close()
+    if self.response_cache is not None:
+      self.response_cache.close()
+
+  def _bootstrap(self, force_refresh_token):
+    """Load the token, apply any forced expiry and build the client session.
+
+    This is the only place the token file is read; update_client works on the in-memory token. Nothing is written
+    here; a forced expiry only lives in memory until the refresh it triggers persists the new token through
+    token_updater.
+    """
+    self.load_token()
+    self.update_client(expires_at=-10 if force_refresh_token else None)
+
+  def get(self, url, use_cache=True):
+    """GET url, serving it from the response cache within its TTL and revalidating it with a conditional GET after"""
+    if (self.response_cache is None) or not use_cache:
+      return self._fetch(url)
+    cached = self.response_cache.lookup(url)
+    if cached is None:
+      resp = self._fetch(url)
     else:
-      self.update_client()
+      etag, last_modified, body, resp_headers, fetched_at = cached
+      if time.time() - fetched_at < response_ttl(url):
+        return cached_response(url, body, resp_headers)
+      headers = {}
+      if etag:
+        headers['If-None-Match'] = etag
+      if last_modified:
+        headers['If-Modified-Since'] = last_modified
+      resp = self._fetch(url, headers=headers)
+      if resp.status_code == 304:
+        self.response_cache.touch(url)
+        return cached_response(url, body, resp_headers)
+    if resp.status_code == 200:
+      self.response_cache.store(url, resp.headers.get('ETag'), resp.headers.get('Last-Modified'), resp.content,
+                                dict(resp.headers))
+    return resp
+
+  def invalidate(self, url_prefix=''):
+    """Drop cached responses for urls starting with url_prefix (everything by default)"""
+    if self.response_cache is not None:
+      self.response_cache.invalidate(url_prefix)
+
+  def _fetch(self, url, headers=None, method='GET'):
+    # refresh ahead of expiry here, under the lock, so concurrent requests don't each trigger the
+    # OAuth2Session's own auto-refresh
+    if not self._token_is_fresh():
+      self.refresh_token(stale_access_token=self.token['access_token'])
+    if self._http2 is None:
+      return self.client.request(method, url, headers=headers)
+    access_token = self.token['access_token']
+    resp = self._http2_request(method, url, headers, access_token)
+    if resp.status_code == 401:
+      self.refresh_token(stale_access_token=access_token)
+      resp = self._http2_request(method, url, headers, self.token['access_token'])
+    return resp
 
-  def get(self, url):
-    return self.client.get(url)
+  def _http2_request(self, method, url, headers, access_token):
+    """Send a request over the HTTP/2 client, retrying transient errors like the requests adapter does.
+
+    The result is converted to a requests.Response, and httpx errors to requests exceptions, so callers see the same
+    types whichever transport is in use.
+    """
+    import httpx  # pylint: disable=import-outside-toplevel
+    import requests  # pylint: disable=import-outside-toplevel
+    headers = {**(headers or {}), 'Authorization': f'Bearer {access_token}'}
+    try:
+      for attempt in range(_RETRY_TOTAL + 1):
+        resp = self._http2.request(method, url, headers=headers)
+        if (resp.status_code not in _RETRY_STATUSES) or (attempt == _RETRY_TOTAL):
+          break
+        time.sleep(_RETRY_BACKOFF_FACTOR * (2 ** attempt))
+    except httpx.TimeoutException as e:
+      raise requests.exceptions.Timeout(str(e)) from e
+    except httpx.HTTPError as e:
+      raise requests.exceptions.ConnectionError(str(e)) from e
+    return cached_response(str(resp.url), resp.content, dict(resp.headers), status_code=resp.status_code,
+                           reason=resp.reason_phrase)
+
+  def get_many(self, urls):
+    """Fetch several urls concurrently, returning responses in the same order"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+      return list(executor.map(self.get, urls))
+
+  def refresh_token(self, stale_access_token=None):
+    """Exchange the refresh token for a new access token, as the OAuth2Session does automatically on expiry.
+
+    If stale_access_token is given, the refresh is skipped when another thread already replaced that token.
+    """
+    with self._refresh_lock:
+      if (stale_access_token is not None) and (self.token['access_token'] != stale_access_token):
+        return
+      token = self.client.refresh_token(_OAUTH_REFRESH_TOKEN_URL, **self.client.auto_refresh_kwargs)
+      self.token_updater(token)
 
   def update_client(self, expires_at=None):
-    if self.token is None:
-      self.load_token()
-    print(self.token)
+    if (self.client is not None) and (expires_at is None) and self._token_is_fresh():
+      return
+    logger.debug(f'updating client for token expiring at {self.token["expires_at"]}')
     self.update_token_expiration(force_value=expires_at)
+    if self.client is not None:
+      # keep the live session (and its open connections); auto_refresh_url + token_updater handle refreshes
+      self.client.token = self.token
+      return
+    import requests_oauthlib  # pylint: disable=import-outside-toplevel
     extra = {
         'client_id': self.client_id,
         'client_secret': self.client_secret,
@@ -84,106 +262,223 @@ class YahooOAuth:
                                                   auto_refresh_kwargs=extra,
                                                   token_updater=self.token_updater
                                                   )
-    self.test_auth()
+    self.client.mount('https://', self._adapter)
+
+  def _token_is_fresh(self):
+    # expires_at is an absolute wall-clock time; a monotonic deadline would stall while the machine is suspended
+    return self.token['expires_at'] - time.time() > self._skew
 
   def token_updater(self, token):
-    print('token updater was called')
-    self.token = token
-    self.save_token()
+    logger.debug('token updater was called')
+    with self._refresh_lock:
+      self.token = token
+      self.save_token()
+      self.update_token_expiration()
 
   def save_token(self):
-    token_path = get_token_filepath(self.client_id)
-    with open(token_path, 'w', encoding="utf-8") as f:
-      json.dump(self.token, f)
-    print(f'[token saved to {token_path}]')
+    token_path = self._token_path
+    payload = _json_dumps(self.token)
+    # write to a sibling file and swap it in, so a crash mid-write never leaves a corrupt token behind
+    # mkstemp gives each writer its own file, created 0600
+    fd, tmp_path = tempfile.mkstemp(prefix=f'{os.path.basename(token_path)}.tmp.', dir=os.path.dirname(token_path))
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        _fdatasync(f.fileno())
+      os.replace(tmp_path, token_path)
+    except BaseException:
+      try:
+        os.remove(tmp_path)
+      except FileNotFoundError:
+        pass
+      raise
+    _TOKEN_CACHE[token_path] = (os.stat(token_path).st_mtime_ns, dict(self.token))
+    logger.info(f'token saved to {token_path}')
 
   def load_token(self):
-    token_path = get_token_filepath(self.client_id)
-    success = False
-    try:
-      with open(token_path, 'r', encoding="utf-8") as f:
-        loaded_token = json.load(f)
-        self.token = loaded_token
-        success = True
-    except FileNotFoundError:
-      print(f'no token file saved at {token_path}.')
-    except json.decoder.JSONDecodeError:
-      print(f'file at {token_path} is not valid json.')
-      os.remove(token_path)
-    else:
-      print(f'loaded token file at {token_path}')
-    if not success:
-      print('Fetching a new token.')
-      self.get_new_token()
+    for token_path in get_token_filepaths(self.client_id):
+      try:
+        mtime_ns = os.stat(token_path).st_mtime_ns
+        cached_mtime_ns, cached_token = _TOKEN_CACHE.get(token_path, (None, None))
+        if cached_mtime_ns == mtime_ns:
+          self.token = dict(cached_token)
+        else:
+          with open(token_path, 'rb') as f:
+            data = f.read()
+          self.token = _json_loads(data)
+          _TOKEN_CACHE[token_path] = (mtime_ns, dict(self.token))
+      except FileNotFoundError:
+        logger.info(f'no token file saved at {token_path}.')
+        continue
+      except json.decoder.JSONDecodeError:
+        logger.warning(f'file at {token_path} is not valid json.')
+        _TOKEN_CACHE.pop(token_path, None)
+        os.remove(token_path)
+        continue
+      logger.debug(f'loaded token file at {token_path}')
+      # keep saving refreshes to the file the token came from, so every context that found it stays current
+      self._token_path = token_path
+      return
+    logger.info('Fetching a new token.')
+    self.get_new_token()
 
   def get_new_token(self):
     """Go through the user auth flow and get a new token"""
-    self.client = requests_oauthlib.OAuth2Session(self.client_id,
-                                                  redirect_uri=self.redirect_uri)
-    auth_url, _ = self.client.authorization_url(_OAUTH_REQUEST_AUTH_URL)
+    import requests_oauthlib  # pylint: disable=import-outside-toplevel
+    oauth = requests_oauthlib.OAuth2Session(self.client_id,
+                                            redirect_uri=self.redirect_uri)
+    oauth.mount('https://', self._adapter)
+    auth_url, _ = oauth.authorization_url(_OAUTH_REQUEST_AUTH_URL)
     print(f'Please go to {auth_url} and authorize access.')
     auth_code = input('Enter the secret code from the auth url: ')
-    self.token = self.client.fetch_token(_OAUTH_GET_TOKEN_URL,
-                                         client_secret=self.client_secret,
-                                         code=auth_code)
-    self.test_auth()
+    self.token = oauth.fetch_token(_OAUTH_GET_TOKEN_URL,
+                                   client_secret=self.client_secret,
+                                   code=auth_code)
     self.save_token()
 
   def update_token_expiration(self, force_value=None):
-    last_expires_in = self.token['expires_in']
-    last_expires_at = self.token['expires_at']
+    """Refresh the remaining-lifetime bookkeeping, optionally forcing the token to expire in force_value seconds.
+
+    Only expires_at is touched; requests_oauthlib prefers it over expires_in, which stays as the server issued it.
+    The token is only persisted when yahoo issues a new one.
+    """
     if force_value is not None:
-      next_expires_in = force_value
-      next_expires_at = time.time() + force_value
-    else:
-      next_expires_in = self.token['expires_at'] - time.time()
-      next_expires_at = last_expires_at
-    if (force_value is None) and (next_expires_in > last_expires_in):
-      warnings.warn(f'possibly bad expires_in value. token.expires_in increased from {last_expires_in}'
-                    f' to {next_expires_in}')
-    self.token['expires_in'] = next_expires_in
-    self.token['expires_at'] = next_expires_at
-    print(f'[token expires_in updated from {last_expires_in} to {next_expires_in}]')
-    print(f'[token expires_at updated from {last_expires_at} to {next_expires_at}]')
-    self.save_token()
+      self.token['expires_at'] = time.time() + force_value
+    self._seconds_remaining = self.token['expires_at'] - time.time()
+    logger.debug(f'token expires_at {self.token["expires_at"]} ({self._seconds_remaining:.0f}s remaining)')
 
   def test_auth(self):
-    """Verify auth by fetching a protected url"""
-    resp = self.get(self.league_url)
+    """Verify auth by requesting the headers of a protected url"""
+    resp = self._fetch(self.league_url, method='HEAD')
+    if resp.status_code != 200:
+      # HEAD may be unsupported, and it carries no error body either way. Re-check with a GET of the bare league
+      # url (just the small league metadata resource) so a real failure reports yahoo's description
+      resp = self.get(self.league_url, use_cache=False)
     if resp.status_code != 200:
       raise RuntimeError(f'Fetching {self.league_url} returned status {resp.status_code}'
                          f' instead of 200. Text:' + '\n' + resp.text)
     # todo: handle errors. maybe try refreshing token
 
 
-def league_api_url_currentyear(league_id):
-  return f'https://fantasysports.yahooapis.com/fantasy/v2/league/nfl.l.{league_id}'
+def get_token_filepath(client_id, token_dir=_TOKEN_DIR):
+  return os.path.join(token_dir, f'oauth2_token_{client_id}.json')
+
+
+def get_token_filepaths(client_id):
+  """Token file locations to load from, most preferred first"""
+  paths = [get_token_filepath(client_id)]
+  legacy_path = get_token_filepath(client_id, _LEGACY_TOKEN_DIR)
+  if legacy_path not in paths:
+    paths.append(legacy_path)
+  return paths
+
+
+def get_response_cache_filepath(client_id):
+  return os.path.join(_TOKEN_DIR, f'yahoo_responses_{client_id}.sqlite')
+
 
+def response_ttl(url):
+  for path_part, ttl in _RESPONSE_TTLS:
+    if path_part in url:
+      return ttl
+  return _DEFAULT_RESPONSE_TTL
 
-def get_token_filepath(client_id):
-  return os.path.join(_TMP_DIR, f'oauth2_token_{client_id}.json')
+
+class ResponseCache:
+  """sqlite store of GET response bodies and their validators, keyed by url"""
+  def __init__(self, path):
+    # get_many calls get from worker threads, so share one connection behind a lock
+    self._lock = threading.Lock()
+    # cached league data is as private as the token next to it. sqlite would create these with umask permissions, and
+    # in a shared /tmp the predictable names could be pre-planted as symlinks or files owned by someone else
+    for file_path in (path, f'{path}-wal', f'{path}-shm'):
+      fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+      try:
+        if hasattr(os, 'getuid') and os.fstat(fd).st_uid != os.getuid():
+          raise PermissionError(f'{file_path} is not owned by the current user')
+        os.fchmod(fd, 0o600)
+      finally:
+        os.close(fd)
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    with self._lock, self._conn:
+      self._conn.execute('PRAGMA journal_mode=WAL')
+      self._conn.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT,'
+                         ' body BLOB, headers BLOB, fetched_at REAL)')
+
+  def lookup(self, url):
+    """Return (etag, last_modified, body, headers, fetched_at) for url, or None if it isn't cached"""
+    with self._lock:
+      row = self._conn.execute('SELECT etag, last_modified, body, headers, fetched_at FROM responses WHERE url = ?',
+                               (url,)).fetchone()
+    if row is None:
+      return None
+    etag, last_modified, body, headers, fetched_at = row
+    return etag, last_modified, body, _json_loads(headers), fetched_at
+
+  def store(self, url, etag, last_modified, body, headers):
+    with self._lock, self._conn:
+      self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                         (url, etag, last_modified, body, _json_dumps(headers), time.time()))
+
+  def touch(self, url):
+    """Restart the TTL of a cached response that the server confirmed is unchanged"""
+    with self._lock, self._conn:
+      self._conn.execute('UPDATE responses SET fetched_at = ? WHERE url = ?', (time.time(), url))
+
+  def invalidate(self, url_prefix=''):
+    with self._lock, self._conn:
+      self._conn.execute('DELETE FROM responses WHERE substr(url, 1, ?) = ?', (len(url_prefix), url_prefix))
+
+  def close(self):
+    with self._lock:
+      self._conn.close()
+
+
+def cached_response(url, body, headers, status_code=200, reason='OK'):
+  """Build a requests.Response from a body and headers, as stored in the ResponseCache or read by httpx"""
+  import requests  # pylint: disable=import-outside-toplevel
+  resp = requests.Response()
+  resp.status_code = status_code
+  resp.reason = reason
+  resp.url = url
+  resp.headers = requests.structures.CaseInsensitiveDict(headers)
+  resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+  resp._content = body  # pylint: disable=protected-access
+  return resp
 
 
 def obtain_credentials(args):
-  """Obtain the client_id, client_secret, and redirect_uri credentials manually if not passed as args."""
+  """Obtain the client_id, client_secret, and redirect_uri credentials.
+
+  Each is taken from args if passed, else from the YAHOO_<LABEL> environment variable. When neither is set,
+  redirect_uri falls back to 'oob' and the others are prompted for manually.
+  """
   creds = {}
   args_dict = vars(args)
   for cred_label in ('client_id', 'client_secret', 'redirect_uri'):
-    if cred_label in args_dict:
-      this_cred = args_dict[cred_label]
-    else:
-      this_cred = manual_cred_input(cred_label)
+    this_cred = args_dict.get(cred_label) or os.environ.get(f'YAHOO_{cred_label.upper()}')
+    if not this_cred and cred_label == 'redirect_uri':
+      this_cred = 'oob'
+    elif not this_cred:
+      this_cred = manual_cred_input(cred_label, secret=(cred_label == 'client_secret'))
     creds[cred_label] = this_cred
   return creds
 
 
-def manual_cred_input(label):
+def manual_cred_input(label, secret=False):
   cred_valid = False
   while not cred_valid:
-    new_cred = input(f'Enter {label}: ')
-    print(f'You entered {label} = "{new_cred}"')
-    conf = input('Enter "y" to confirm or any other key to redo: ')
-    cred_valid = conf.lower() == 'y'
+    if secret:
+      new_cred = getpass.getpass(f'Enter {label}: ')
+      cred_valid = getpass.getpass(f'Re-enter {label} to confirm: ') == new_cred
+      if not cred_valid:
+        print(f'{label} entries did not match.')
+    else:
+      new_cred = input(f'Enter {label}: ')
+      print(f'You entered {label} = "{new_cred}"')
+      conf = input('Enter "y" to confirm or any other key to redo: ')
+      cred_valid = conf.lower() == 'y'
   return new_cred
 
 